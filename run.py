@@ -1,13 +1,22 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 import errno
+from functools import lru_cache
 import grp
-from glob import glob
+import koji
 import os
 import re
 import subprocess
 import sys
+import time
+import uuid
+try:
+    import rpm
+except ImportError:
+    rpm = None
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # Intended to run in Jenkins after every new Git tag.
@@ -24,11 +33,45 @@ import requests
 #         tags:
 #          - storage7-ceph-luminous-candidate
 
+# Ceph releases and RPM dists for each ceph-ansible version series. For each
+# dist, we build in the first release's target, and tag into every release's
+# -candidate tag.
+_RELEASE_MAP = {
+    (3, 0): (['jewel'], ('el7',)),
+    (3, 2): (['luminous', 'mimic'], ('el7',)),
+    (4, 0): (['nautilus'], ('el7', 'el8')),
+}
+
+# A ceph-ansible version or Git tag, eg. "v3.0.0rc7"
+_TAG_RE = re.compile(r'^v?(\d+)\.(\d+)\.')
+
+# One rpmdb handle for the whole run, rather than one "rpm -q" per package.
+_ts = rpm.TransactionSet() if rpm else None
+
+# Shared HTTP connection pool for everything we download.
+_http = requests.Session()
+_http.mount('https://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.3)))
+
+# Set once ensure_prereqs() has passed.
+_prereqs_done = False
+
+# Set once the CentOS server CA cert is known to be in place.
+_ca_ready = False
+
+
 def ensure_prereqs():
     """ Ensure everything is set up as expected. """
+    global _prereqs_done
+    if _prereqs_done:
+        return
     # Ensure we are a member of the "mock" Unix group.
-    groups = [grp.getgrgid(g).gr_name for g in os.getgroups()]
-    if 'mock' not in groups:
+    try:
+        mock_gid = grp.getgrnam('mock').gr_gid
+    except KeyError:
+        raise RuntimeError('no "mock" group on this system.')
+    if mock_gid not in os.getgroups():
         raise RuntimeError('current user not in the "mock" group.')
 
     # Ensure centos-packager (ie, /usr/bin/cbs) is installed.
@@ -37,11 +80,14 @@ def ensure_prereqs():
     ensure_centos_cert()
     ensure_server_ca()
 
-    sys.stdout.flush()
-
     subprocess.check_call(['centos-cert', '-v'])
 
-    subprocess.check_call(['cbs', 'hello'])
+    # Equivalent to "cbs hello", on the session we'll use for the builds.
+    session = _login()
+    user = session.getLoggedInUser()
+    print('logged in to %s as %s' % (session.baseurl, user['name']))
+
+    _prereqs_done = True
 
 
 def ensure_centos_cert():
@@ -51,45 +97,74 @@ def ensure_centos_cert():
         # Manual testing? don't bother setting up the cert symlink.
         print('CENTOS_CERT env var is not set. Not touching %s' % certpath)
         return
+    centos_cert = os.environ['CENTOS_CERT']
+    # Swap the new symlink into place atomically, so that nothing else ever
+    # sees certpath missing.
+    tmppath = '%s.tmp.%d' % (certpath, os.getpid())
     try:
-        os.unlink(certpath)
+        os.unlink(tmppath)
     except OSError as e:
         if e.errno != errno.ENOENT:
             raise
-    centos_cert = os.environ['CENTOS_CERT']
-    os.symlink(centos_cert, certpath)
+    os.symlink(centos_cert, tmppath)
+    os.replace(tmppath, certpath)
 
 
 def ensure_server_ca():
     """ Ensure that the CentOS server cert authority is in place. """
     # copied from centos-packager (GPLv3)
+    global _ca_ready
+    if _ca_ready:
+        return
     servercapath = os.path.expanduser('~/.centos-server-ca.cert')
-    if os.path.exists(servercapath):
+    try:
+        open(servercapath, 'rb').close()
+        _ca_ready = True
         return
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
     servercaurl = 'https://accounts.centos.org/ca/ca-cert.pem'
     print('downloading %s to %s' % (servercaurl, servercapath))
-    with open(servercapath, 'w') as servercacertfile:
-        r = requests.get(servercaurl)
+    with _http.get(servercaurl, stream=True, timeout=(5, 30)) as r:
         try:
             r.raise_for_status()
         except requests.exceptions.HTTPError as e:
             print("""Could not download CA Certificate!
 Response Code: {0}
-Message: {1}""".format(e.response.status_code, e.response.reason)).strip()
+Message: {1}""".format(e.response.status_code, e.response.reason).strip())
             sys.exit(1)
-        response = r.text
-        servercacertfile.write(response)
+        # Write the bytes straight to disk, without decoding to text. Only
+        # move the file into place once it is complete, so that a failed
+        # download never leaves a truncated CA behind.
+        tmppath = '%s.tmp.%d' % (servercapath, os.getpid())
+        try:
+            with open(tmppath, 'wb') as servercacertfile:
+                for chunk in r.iter_content(64 * 1024):
+                    servercacertfile.write(chunk)
+            os.replace(tmppath, servercapath)
+        except BaseException:
+            try:
+                os.unlink(tmppath)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            raise
+    _ca_ready = True
 
 
 def ensure_package(pkg):
-    cmd = ['rpm', '-qv', pkg]
-    try:
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError:
+    """ Install this package with yum, unless it is already installed. """
+    if _ts is not None:
+        installed = _ts.dbMatch('name', pkg).count() > 0
+    else:
+        installed = subprocess.call(['rpm', '-qv', pkg]) == 0
+    if not installed:
         cmd = ['sudo', 'yum', '-y', 'install', pkg]
         subprocess.check_call(cmd)
 
 
+@lru_cache(maxsize=1)
 def get_version():
     """ Get a version from "git describe".  """
     cmd = ['git', 'describe', '--tags', '--abbrev=0', '--match', 'v*']
@@ -98,24 +173,66 @@ def get_version():
     except subprocess.CalledProcessError:
         print('failed to find "v" git tags in %s' % os.getcwd())
         raise
-    # py3 needs to decode output here before returning...
-    return output
+    return output.decode('utf-8').strip()
 
 
-def cbs_build(target, srpm, scratch=False):
+def submit_cbs_build(target, srpm, scratch=False):
     """
-    Build a SRPM in CBS for a target.
+    Upload a SRPM to CBS and start a build for a target, without waiting for
+    the build to finish.
 
     :param target: a CBS target, eg. storage7-ceph-jewel-el7
     :param   srpm: path to a .src.rpm file.
+    :returns: ``int``, the CBS build task ID.
     """
-    cmd = ['cbs', 'build', '--wait', target, srpm]
+    session = _login()
+    serverdir = 'cli-build/%s' % uuid.uuid4().hex
+    print('uploading %s to %s' % (srpm, session.baseurl))
+    session.uploadWrapper(srpm, serverdir)
+    source = '%s/%s' % (serverdir, os.path.basename(srpm))
+    opts = {}
     if scratch:
-        cmd += ['--scratch']
-    subprocess.check_call(cmd)
-    return srpm_nvr(srpm)
+        opts['scratch'] = True
+    task_id = session.build(source, target, opts)
+    print('building %s in %s/taskinfo?taskID=%d'
+          % (srpm, _koji_config()['weburl'], task_id))
+    return task_id
+
+
+def watch_tasks(task_ids, poll_interval=2, max_interval=60):
+    """
+    Wait for CBS tasks to finish.
 
+    The koji hub has no way to notify us when a task finishes, so we poll.
+    Builds take minutes, so the polls back off instead of hitting the hub
+    constantly.
 
+    :param task_ids: a list of CBS task IDs, eg. [123456, 123457]
+    :param poll_interval: seconds to wait before the first re-check. This
+                          doubles after every check, up to max_interval.
+    :param max_interval: the longest number of seconds between checks.
+    :raises: ``RuntimeError`` if any task failed or was canceled.
+    """
+    session = _session()
+    pending = set(task_ids)
+    while pending:
+        # Check every pending task in one hub round-trip.
+        with session.multicall(strict=True) as m:
+            calls = [(task_id, m.getTaskInfo(task_id))
+                     for task_id in sorted(pending)]
+        for task_id, call in calls:
+            state = koji.TASK_STATES[call.result['state']]
+            if state == 'CLOSED':
+                print('CBS task %d completed' % task_id)
+                pending.remove(task_id)
+            elif state in ('FAILED', 'CANCELED'):
+                raise RuntimeError('CBS task %d is %s' % (task_id, state))
+        if pending:
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, max_interval)
+
+
+@lru_cache()
 def get_cbs_target(version, dist='el7'):
     """
     Return a CBS build target for this ceph-ansible version.
@@ -131,72 +248,135 @@ def get_cbs_target(version, dist='el7'):
     :returns: ``str``, eg "storage7-ceph-jewel-el7", or None if we should not
                build this tag.
     """
-    version = re.sub('^v', '', version)
-    if version.startswith('3.0.'):
-        return 'storage7-ceph-jewel-el7'
-    if version.startswith('3.2.'):
-        return 'storage7-ceph-luminous-el7'
-    if version.startswith('4.0.'):
-        if dist == 'el7':
-            return 'storage7-ceph-nautilus-el7'
-        elif dist == 'el8':
-            return 'storage8-ceph-nautilus-el8'
-    return None
+    releases = _releases(version, dist)
+    if not releases:
+        return None
+    return '%s-ceph-%s-%s' % (_sig_release(dist), releases[0], dist)
 
 
+@lru_cache()
 def get_needed_cbs_tags(version, dist='el7'):
     """
     Return all the CBS tags that should have this ceph-ansible version.
 
     :param version: a ceph-ansible Git tag, eg. "v3.0.0rc7"
     :param dist: the RPM dist value, eg. "el7"
-    :returns: ``list`` of ``str``, eg ["storage7-ceph-jewel-candidate"]
-    """
-    version = re.sub('^v', '', version)
-    releases = []
-    if version.startswith('3.0.'):
-        releases = ['jewel']
-    if version.startswith('3.2.'):
-        releases = ['luminous', 'mimic']
-    if version.startswith('4.0.'):
-        releases = ['nautilus']
-    sig_release = 'storage7'
-    if dist == 'el8':
-        sig_release = 'storage8'
+    :returns: ``tuple`` of ``str``, eg ("storage7-ceph-jewel-candidate",)
+    """
+    releases = _releases(version, dist) or []
+    sig_release = _sig_release(dist)
     tags = []
     for release in releases:
         tags.append(sig_release + '-ceph-' + release + '-candidate')
-    return tags
+    # Callers share this cached value, so don't let them modify it.
+    return tuple(tags)
 
 
-def get_cbs_tag_list(nvr):
+def get_dists(version):
     """
-    Return all the CBS tags for this build.
+    Return the RPM dists we build for this ceph-ansible version.
 
-    :param nvr: a build Name-Version-Release that has been built.
-    :returns: ``list`` of ``str``, eg ["storage7-ceph-jewel-candidate"]
+    :param version: a ceph-ansible Git tag, eg. "v4.0.0"
+    :returns: ``tuple`` of ``str``, eg ("el7", "el8"), or an empty tuple if
+              we do not ship this version.
     """
-    import koji
-    conf = koji.read_config('cbs')
-    hub = conf['server']
-    print('searching %s for %s tags' % (hub, nvr))
-    session = koji.ClientSession(hub, {})
-    tags = session.listTags(nvr)
-    return [tag['name'] for tag in tags]
+    series = _series(version)
+    if series is None:
+        return ()
+    _, dists = series
+    return dists
 
 
-def tag_build(nvr, tag):
+def _releases(version, dist):
     """
-    Tag this build NVR into this CBS tag.
+    Return the Ceph releases for this ceph-ansible version and dist.
 
-    :param nvr: a build Name-Version-Release, for example
-                "ceph-ansible-3.0.0-0.1.rc10.1.el7"
-    :param tag: a CBS tag, eg "storage7-ceph-luminous-candidate"
+    :param version: a ceph-ansible Git tag, eg. "v3.0.0rc7"
+    :param dist: the RPM dist value, eg. "el7"
+    :returns: ``list`` of ``str``, eg ["jewel"], or None if we do not ship
+              this version for this dist.
     """
-    cmd = ['cbs', 'tag', tag, nvr]
-    subprocess.check_call(cmd)
+    series = _series(version)
+    if series is None:
+        return None
+    releases, dists = series
+    if dist not in dists:
+        return None
+    return releases
+
+
+def _series(version):
+    """
+    Return the _RELEASE_MAP entry for this ceph-ansible version.
 
+    :param version: a ceph-ansible Git tag, eg. "v3.0.0rc7"
+    :returns: ``tuple`` of the Ceph releases ``list`` and the RPM dists
+              ``tuple``, or None if we do not ship this version.
+    """
+    match = _TAG_RE.match(version)
+    if not match:
+        return None
+    series = (int(match.group(1)), int(match.group(2)))
+    return _RELEASE_MAP.get(series)
+
+
+def _sig_release(dist):
+    """
+    Return the Storage SIG's CBS prefix for this dist, eg. "storage7".
+    """
+    return 'storage' + dist[len('el'):]
 
+
+@lru_cache(maxsize=1)
+def _koji_config():
+    """
+    Return the "cbs" koji client configuration.
+    """
+    return koji.read_config('cbs')
+
+
+@lru_cache(maxsize=1)
+def _session():
+    """
+    Return a koji ClientSession for the CBS hub.
+
+    The session is created once and reused, so every query shares one
+    connection to the hub.
+    """
+    return koji.ClientSession(_koji_config()['server'], {})
+
+
+def _login():
+    """
+    Return the CBS koji session, logged in with our CentOS cert.
+
+    We log in at most once per run, since every caller shares the session.
+    """
+    session = _session()
+    if not session.logged_in:
+        conf = _koji_config()
+        session.ssl_login(cert=conf['cert'], serverca=conf['serverca'])
+    return session
+
+
+def tag_builds(builds):
+    """
+    Tag several build NVRs into CBS tags at once.
+
+    :param builds: a ``dict`` of build NVRs to iterables of CBS tags, eg
+                   {"ceph-ansible-3.0.0-0.1.rc10.1.el7":
+                    ["storage7-ceph-luminous-candidate"]}
+    """
+    session = _login()
+    # Request every tag in one hub round-trip, and let the hub run all the
+    # tag tasks concurrently.
+    with session.multicall(strict=True) as m:
+        calls = [m.tagBuild(tag, nvr)
+                 for nvr, tags in builds.items() for tag in tags]
+    watch_tasks([call.result for call in calls])
+
+
+@lru_cache(maxsize=16)
 def srpm_nvr(srpm):
     """
     Return the build NVR from this SRPM file.
@@ -204,35 +384,73 @@ def srpm_nvr(srpm):
     :param version: a SRPM file, eg. ceph-ansible-3.0.0-0.1.rc10.1.el7.src.rpm
     :returns: ``str``, eg. ceph-ansible-3.0.0-0.1.rc10.1.el7
     """
-    filename = os.path.basename(srpm)
+    filename = srpm.rsplit('/', 1)[-1]
     if not filename.endswith('.src.rpm'):
         raise ValueError('%s does not look like a SRPM' % filename)
     return filename[:-8]
 
 
-def get_cbs_build(srpm):
+def get_cbs_builds(nvrs):
+    """
+    Look up several builds and their CBS tags in a single hub round-trip.
+
+    :param nvrs: an iterable of build Name-Version-Releases, for example
+                 ["ceph-ansible-4.0.0-1.el7", "ceph-ansible-4.0.0-1.el8"]
+    :returns: ``dict`` of each NVR to a ``tuple`` of the completed build's
+               NVR ``str`` and its ``list`` of CBS tag names, eg.
+               ("ceph-ansible-4.0.0-1.el7",
+                ["storage7-ceph-nautilus-candidate"]).
+               ``(None, [])`` if the completed build does not exist in CBS.
+    """
+    nvrs = list(nvrs)
+    session = _session()
+    print('searching %s for %s' % (session.baseurl, ', '.join(nvrs)))
+    # listTags() faults for a build that does not exist, so defer that error
+    # until we know whether we need its result.
+    with session.multicall(strict=False) as m:
+        calls = [(nvr, m.getBuild(nvr), m.listTags(nvr)) for nvr in nvrs]
+    builds = {}
+    for nvr, build_call, tags_call in calls:
+        build = build_call.result
+        if build is None:
+            builds[nvr] = (None, [])
+        elif koji.BUILD_STATES[build['state']] != 'COMPLETE':
+            builds[nvr] = (None, [])
+        else:
+            builds[nvr] = (nvr, [tag['name'] for tag in tags_call.result])
+    return builds
+
+
+@lru_cache()
+def make(target):
+    """
+    Run a ceph-ansible Makefile target, at most once per run.
+
+    The spec and the source tarball do not depend on the RPM dist value, so
+    every dist can share one run of each target.
+
+    :param target: a Makefile target, eg. "spec"
     """
-    Return the Name-Version-Release if a build already exists in CBS for this
-    SRPM, or None if it does not exist.
+    subprocess.check_call(['make', '-j', str(os.cpu_count() or 1), target])
 
-    :param version: a SRPM file name,
-                    eg. ceph-ansible-3.0.0-0.1.rc10.1.el7.src.rpm
+
+@lru_cache()
+def get_spec_nvr(dist='el7'):
+    """
+    Return the build NVR that make_srpm() would produce, without spending
+    the time to assemble the SRPM.
+
+    :param dist: the RPM dist value, eg. "el7"
     :returns: ``str``, eg. "ceph-ansible-3.0.0-0.1.rc10.1.el7"
-               if the completed build exists in CBS.
-               ``None`` if the completed build does not exist in CBS.
-    """
-    nvr = srpm_nvr(srpm)
-    import koji  # oh yeah
-    conf = koji.read_config('cbs')
-    hub = conf['server']
-    print('searching %s for %s' % (hub, nvr))
-    session = koji.ClientSession(hub, {})
-    build = session.getBuild(nvr)
-    if build is None:
-        return None
-    if koji.BUILD_STATES[build['state']] == 'COMPLETE':
-        return nvr
-    return None
+    """
+    make('spec')
+    cmd = ['rpmspec', '-q', '--srpm',
+           '--queryformat', '%{name}-%{version}-%{release}\n',
+           '--define', 'dist .%s' % dist,
+           'ceph-ansible.spec',
+           ]
+    output = subprocess.check_output(cmd).decode('utf-8')
+    return output.strip()
 
 
 def make_srpm(dist='el7'):
@@ -242,12 +460,10 @@ def make_srpm(dist='el7'):
     :param dist: the RPM dist value, eg. "el7"
     :returns: ``str``, eg. "ceph-ansible-3.0.0-0.1.rc10.1.el7.src.rpm"
     """
-
-    cmd = ['make', 'srpm']
     # Workaround the incompat between fedpkg and centos-packager
     # (needs to go into ceph-ansible Makefile upstream..)
-    subprocess.check_call(['make', 'dist', 'spec'])
-    subprocess.check_call(['make', 'spec'])
+    make('dist')
+    make('spec')
     cmd = ['rpmbuild', '-bs', 'ceph-ansible.spec',
            '--define', '_topdir .',
            '--define', '_sourcedir .',
@@ -256,40 +472,63 @@ def make_srpm(dist='el7'):
            ]
     subprocess.check_call(cmd)
     # TODO: cat some logs if that call failed?
-    files = glob('ceph-ansible-*.%s*.src.rpm' % dist)
-    if not files:
-        raise RuntimeError('could not find ceph-ansible .src.rpm for '
-                           'dist %s' % dist)
-    if len(files) > 1:
-        raise RuntimeError('multiple ceph-ansible .src.rpm files found')
-    return files[0]
+    # rpmspec already told us which file rpmbuild writes.
+    return get_spec_nvr(dist) + '.src.rpm'
 
 
 if __name__ == '__main__':
+    # Flush each line before a subprocess can write to the same Jenkins log.
+    sys.stdout.reconfigure(line_buffering=True)
     ensure_prereqs()
     version = get_version()
-    version = re.sub('^v', '', version)
-    if version.startswith('4.0.'):
-        dists = ['el7', 'el8']
-    else:
-        dists = ['el7']
+    dists = get_dists(version)
+    if not dists:
+        print('No CBS build target configured for %s. Quitting' % version)
+        raise SystemExit()
+    targets = {}
     for dist in dists:
-        srpm = make_srpm(dist)
+        targets[dist] = get_cbs_target(version, dist)
 
-        target = get_cbs_target(version, dist)
-        if not target:
-            print('No CBS build target configured for %s. Quitting' % version)
-            raise SystemExit()
-
-        nvr = get_cbs_build(srpm)
-        if nvr is None:
-            nvr = cbs_build(target, srpm)
-        else:
+    # rpmspec can tell us the NVRs in a fraction of the time it takes to
+    # assemble the SRPMs, so only do that when CBS lacks a build.
+    spec_nvrs = {}
+    for dist in dists:
+        spec_nvrs[dist] = get_spec_nvr(dist)
+    found = get_cbs_builds(spec_nvrs.values())
+
+    # Assemble the SRPMs one at a time, since every dist shares this
+    # working tree. CBS builds every dist at the same time, so submit each
+    # build as soon as its SRPM is ready, and wait on them afterwards.
+    builds = {}
+    tasks = {}
+    for dist in dists:
+        nvr, already_tagged = found[spec_nvrs[dist]]
+        if nvr is not None:
             print('%s has already been built in CBS. Skipping build.' % nvr)
+            builds[dist] = (nvr, already_tagged)
+            continue
 
-        # Tag this build into any additional desired CBS tags
+        srpm = make_srpm(dist)
+        tasks[dist] = (submit_cbs_build(targets[dist], srpm), srpm)
+
+    if tasks:
+        watch_tasks([task_id for task_id, _ in tasks.values()])
+        built = get_cbs_builds(srpm_nvr(srpm) for _, srpm in tasks.values())
+        for dist, (_, srpm) in tasks.items():
+            nvr, already_tagged = built[srpm_nvr(srpm)]
+            if nvr is None:
+                raise RuntimeError('CBS has no completed build of %s'
+                                   % srpm_nvr(srpm))
+            builds[dist] = (nvr, already_tagged)
+
+    # Tag the builds into any additional desired CBS tags
+    to_tag = {}
+    for dist, (nvr, already_tagged) in builds.items():
         needed_tags = get_needed_cbs_tags(version, dist)
-        already_tagged = get_cbs_tag_list(nvr)
-        for tag in set(needed_tags) - set(already_tagged):
-            print('tagging %s into %s' % (nvr, tag))
-            tag_build(nvr, tag)
+        missing_tags = frozenset(needed_tags) - frozenset(already_tagged)
+        if missing_tags:
+            print('tagging %s into %s'
+                  % (nvr, ', '.join(sorted(missing_tags))))
+            to_tag[nvr] = missing_tags
+    if to_tag:
+        tag_builds(to_tag)